@@ -3,6 +3,7 @@ import os
 import re
 import logging
 import torch
+import torch.utils.checkpoint
 
 from torch import nn
 from torch.nn import CrossEntropyLoss, MSELoss
@@ -375,6 +376,7 @@ class NeZhaEncoder(nn.Module):
         self.output_attentions = config.output_attentions
         self.output_hidden_states = config.output_hidden_states
         self.layer = nn.ModuleList([NeZhaLayer(config) for _ in range(config.num_hidden_layers)])
+        self.gradient_checkpointing = False
 
     def forward(
             self,
@@ -389,9 +391,15 @@ class NeZhaEncoder(nn.Module):
         for i, layer_module in enumerate(self.layer):
             if self.output_hidden_states:
                 all_hidden_states = all_hidden_states + (hidden_states,)
-            layer_outputs = layer_module(
-                hidden_states, attention_mask, head_mask[i], encoder_hidden_states, encoder_attention_mask
-            )
+            if self.gradient_checkpointing and self.training:
+                layer_outputs = torch.utils.checkpoint.checkpoint(
+                    layer_module, hidden_states, attention_mask, head_mask[i], encoder_hidden_states,
+                    encoder_attention_mask, use_reentrant=False
+                )
+            else:
+                layer_outputs = layer_module(
+                    hidden_states, attention_mask, head_mask[i], encoder_hidden_states, encoder_attention_mask
+                )
             hidden_states = layer_outputs[0]
             if self.output_attentions:
                 all_attentions = all_attentions + (layer_outputs[1],)
@@ -415,6 +423,7 @@ class NeZhaPreTrainedModel(PreTrainedModel):
     pretrained_model_archive_map = NEZHA_PRETRAINED_MODEL_ARCHIVE_MAP
     load_tf_weights = load_tf_weights_in_nezha
     base_model_prefix = "bert"
+    supports_gradient_checkpointing = True
 
     def _init_weights(self, module):
         """ Initialize the weights """
@@ -428,6 +437,10 @@ class NeZhaPreTrainedModel(PreTrainedModel):
         if isinstance(module, nn.Linear) and module.bias is not None:
             module.bias.data.zero_()
 
+    def _set_gradient_checkpointing(self, module, value=False):
+        if isinstance(module, NeZhaEncoder):
+            module.gradient_checkpointing = value
+
     def save_pretrained(
             self,
             save_directory: Union[str, os.PathLike],
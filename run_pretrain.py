@@ -4,41 +4,53 @@ import gc
 import re
 import os
 import sys
-import pickle
+import itertools
 import random
 import shutil
+import threading
 import warnings
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 
 from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from functools import partial
 from typing import List, Tuple, Optional
-from argparse import ArgumentParser
-from collections import defaultdict
-from transformers import BertTokenizer, AdamW
+from argparse import ArgumentParser, BooleanOptionalAction
+from transformers import BertTokenizerFast
 from transformers.trainer_utils import PREFIX_CHECKPOINT_DIR
 
 import torch
 from torch.optim.lr_scheduler import LambdaLR
-from torch.utils.data import Dataset, DataLoader
-from torch.cuda.amp import autocast as autocast, GradScaler
+from torch.utils.data import Dataset, DataLoader, Sampler
+from torch.cuda.amp import GradScaler
 
 from nezha.modeling.modeling import NeZhaConfig, NeZhaForMaskedLM
 
 warnings.filterwarnings('ignore')
 
+# the strings pandas reads as NaN by default; the old NaN -> '无' mapping applied to all of them
+_NA_STRINGS = ['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN',
+               '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null']
+_CKPT_RE = re.compile(rf'.*{PREFIX_CHECKPOINT_DIR}-([0-9]+)$')
 
-def save_pickle(dic, save_path):
+
+def save_npz(dic, save_path):
+    # through a file handle np.savez keeps the path as given instead of appending '.npz'
     with open(save_path, 'wb') as f:
-        pickle.dump(dic, f)
+        np.savez(f, **dic)
+
+
+def load_npz(load_path):
+    with np.load(load_path) as f:
+        array_dict = dict(f)
+    return array_dict
 
 
-def load_pickle(load_path):
-    with open(load_path, 'rb') as f:
-        message_dict = pickle.load(f)
-    return message_dict
+def flatten_sequences(sequences: List[List[int]], num_values: int, dtype=np.int32) -> np.ndarray:
+    return np.fromiter(itertools.chain.from_iterable(sequences), dtype=dtype, count=num_values)
 
 
 def seed_everything(seed):
@@ -52,94 +64,218 @@ def seed_everything(seed):
     torch.backends.cudnn.deterministic = True
 
 
-def read_data(args, tokenizer: BertTokenizer) -> dict:
+def read_corpus(args) -> Tuple[List[str], List[str]]:
     train_path = os.path.join(args.pretrain_data_dir, 'train.csv')
     test_path = os.path.join(args.pretrain_data_dir, 'testa_nolabel.csv')
 
-    train_df = pd.read_csv(train_path, sep=',')
-    test_df = pd.read_csv(test_path, sep=',')
-
-    if args.debug:
-        train_df = train_df.head(3000)
-        test_df = test_df.head(300)
-
-    inputs = defaultdict(list)
-    for i, row in tqdm(train_df.iterrows(), desc='', total=len(train_df)):
-        id, name, content, label = row[0], row[1], row[2], row[3]
-        if str(name) == 'nan':
-            name = '无'
-        if str(content) == 'nan':
-            content = '无'
-        inputs_dict = tokenizer.encode_plus(name, content, add_special_tokens=True,
-                                            return_token_type_ids=True, return_attention_mask=True)
-
-        inputs['input_ids'].append(inputs_dict['input_ids'])
-        inputs['token_type_ids'].append(inputs_dict['token_type_ids'])
-        inputs['attention_mask'].append(inputs_dict['attention_mask'])
-
-    for i, row in tqdm(test_df.iterrows(), desc='', total=len(test_df)):
-        id, name, content = row[0], row[1], row[2]
-        if str(name) == 'nan':
-            name = '无'
-        if str(content) == 'nan':
-            content = '无'
-        inputs_dict = tokenizer.encode_plus(name, content, add_special_tokens=True,
-                                            return_token_type_ids=True, return_attention_mask=True)
-
-        inputs['input_ids'].append(inputs_dict['input_ids'])
-        inputs['token_type_ids'].append(inputs_dict['token_type_ids'])
-        inputs['attention_mask'].append(inputs_dict['attention_mask'])
+    text_columns = ['name', 'content']
+    read_kwargs = dict(sep=',', usecols=text_columns, dtype=str, engine='c', na_filter=False)
+    train_df = pd.read_csv(train_path, nrows=3000 if args.debug else None, **read_kwargs)
+    test_df = pd.read_csv(test_path, nrows=300 if args.debug else None, **read_kwargs)
+
+    corpus_df = pd.concat([train_df, test_df], ignore_index=True)
+    # na_filter=False keeps missing fields as raw strings, so no float NaN to check for
+    corpus_df = corpus_df.replace({na_string: '无' for na_string in _NA_STRINGS})
+
+    return corpus_df['name'].tolist(), corpus_df['content'].tolist()
+
+
+def read_data(args, tokenizer: BertTokenizerFast) -> dict:
+    names, contents = read_corpus(args)
+    inputs_dict = tokenizer(names, contents, add_special_tokens=True,
+                            return_token_type_ids=True, return_attention_mask=False, return_length=False)
+    input_ids, token_type_ids = inputs_dict['input_ids'], inputs_dict['token_type_ids']
+
+    # SoA layout: sequence i of every field is values[offsets[i]:offsets[i + 1]].
+    # The attention mask is all ones before padding, so it is rebuilt from the lengths instead of stored.
+    lengths = np.fromiter(map(len, input_ids), dtype=np.int32, count=len(input_ids))
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    # store ids in the narrowest type that holds the vocabulary; they are widened to long on the device
+    ids_dtype = np.uint16 if len(tokenizer) <= np.iinfo(np.uint16).max + 1 else np.int32
+    inputs = {
+        'input_ids': flatten_sequences(input_ids, int(offsets[-1]), ids_dtype),
+        'token_type_ids': flatten_sequences(token_type_ids, int(offsets[-1]), np.int8),
+        'offsets': offsets,
+        'lengths': lengths
+    }
 
     os.makedirs(os.path.dirname(args.data_cache_path), exist_ok=True)
-    save_pickle(inputs, args.data_cache_path)
+    save_npz(inputs, args.data_cache_path)
 
     return inputs
 
 
 class DGDataset(Dataset):
-    def __init__(self, data_dict: dict):
+    def __init__(self, input_ids: np.ndarray, token_type_ids: np.ndarray, offsets: np.ndarray,
+                 lengths: np.ndarray):
         super(Dataset, self).__init__()
-        self.data_dict = data_dict
+        self.input_ids = input_ids
+        self.token_type_ids = token_type_ids
+        self.offsets = offsets
+        self.lengths = lengths
 
     def __getitem__(self, index: int) -> tuple:
-        data = (self.data_dict['input_ids'][index],
-                self.data_dict['token_type_ids'][index],
-                self.data_dict['attention_mask'][index])
+        start, end = self.offsets[index], self.offsets[index + 1]
+        data = (self.input_ids[start:end],
+                self.token_type_ids[start:end],
+                self.lengths[index])
+
+        return data
+
+    def __getitems__(self, indices: List[int]) -> tuple:
+        # DataLoader fetches a whole batch through this hook when it exists, instead of one __getitem__ per index
+        starts, ends = self.offsets[indices], self.offsets[np.add(indices, 1)]
+        data = ([self.input_ids[start:end] for start, end in zip(starts, ends)],
+                [self.token_type_ids[start:end] for start, end in zip(starts, ends)],
+                self.lengths[indices])
 
         return data
 
     def __len__(self) -> int:
-        return len(self.data_dict['input_ids'])
+        return len(self.lengths)
+
+
+def pack_strings(strings: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    encoded = [string.encode('utf-8') for string in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum(np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded)), out=offsets[1:])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+class RawTextDataset(Dataset):
+    """
+    Keeps the corpus as packed utf-8 bytes and leaves tokenization to the collator, i.e. to the dataloader
+    workers. `lengths` counts characters, which tracks the token count of Chinese text closely enough for
+    length bucketing.
+    """
+
+    def __init__(self, names: List[str], contents: List[str]):
+        super(Dataset, self).__init__()
+        self.name_bytes, self.name_offsets = pack_strings(names)
+        self.content_bytes, self.content_offsets = pack_strings(contents)
+        # + 3 for [CLS] and the two [SEP]
+        self.lengths = np.fromiter((len(name) + len(content) + 3 for name, content in zip(names, contents)),
+                                   dtype=np.int32, count=len(names))
+
+    def __getitem__(self, index: int) -> tuple:
+        name = self.name_bytes[self.name_offsets[index]:self.name_offsets[index + 1]].tobytes().decode('utf-8')
+        content = self.content_bytes[self.content_offsets[index]:self.content_offsets[index + 1]].tobytes()
+
+        return name, content.decode('utf-8')
+
+    def __len__(self) -> int:
+        return len(self.lengths)
+
+
+class LengthBucketSampler(Sampler):
+    """
+    Yields batches of indices whose sequences have similar lengths, so batches padded to their longest sequence
+    carry little padding. Samples are sorted by length, cut into windows of `batch_size * bucket_batches` samples,
+    shuffled inside each window and chunked into batches; the batch order is shuffled every epoch.
+    """
+
+    def __init__(self, lengths: np.ndarray, batch_size: int, bucket_batches: int = 50):
+        super(LengthBucketSampler, self).__init__(None)
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.bucket_size = batch_size * bucket_batches
+
+    def __iter__(self):
+        # permute before the stable sort so equal-length samples are ordered differently every epoch
+        indices = np.random.permutation(len(self.lengths))
+        indices = indices[np.argsort(self.lengths[indices], kind='stable')]
+
+        batches = []
+        for bucket_start in range(0, len(indices), self.bucket_size):
+            bucket = np.random.permutation(indices[bucket_start:bucket_start + self.bucket_size])
+            batches.extend(bucket[i:i + self.batch_size] for i in range(0, len(bucket), self.batch_size))
+
+        for batch_id in np.random.permutation(len(batches)):
+            yield batches[batch_id].tolist()
+
+    def __len__(self) -> int:
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
 
 
 class DGDataCollator:
-    def __init__(self, max_seq_len: int, tokenizer: BertTokenizer, mlm_probability=0.15):
+    def __init__(self, max_seq_len: int, tokenizer: BertTokenizerFast):
         self.max_seq_len = max_seq_len
         self.tokenizer = tokenizer
-        self.mlm_probability = mlm_probability
-        self.special_token_ids = {tokenizer.cls_token_id, tokenizer.sep_token_id}
 
-    def pad_and_truncate(self, input_ids_list, token_type_ids_list,
-                         attention_mask_list, max_seq_len):
+    def pad_and_truncate(self, input_ids_list, token_type_ids_list, seq_lens, max_seq_len):
 
-        input_ids = torch.zeros((len(input_ids_list), max_seq_len), dtype=torch.long)
-        token_type_ids = torch.zeros_like(input_ids)
-        attention_mask = torch.zeros_like(input_ids)
+        # narrow buffers keep the pinned copy small, batch2cuda widens them to long after the transfer
+        input_ids = np.zeros((len(input_ids_list), max_seq_len), dtype=np.int32)
+        token_type_ids = np.zeros((len(input_ids_list), max_seq_len), dtype=np.int8)
+        attention_mask = np.zeros_like(token_type_ids)
 
         for i in range(len(input_ids_list)):
-            seq_len = len(input_ids_list[i])
+            seq_len = min(seq_lens[i], max_seq_len)
 
-            if seq_len <= max_seq_len:
-                input_ids[i, :seq_len] = torch.tensor(input_ids_list[i], dtype=torch.long)
-                token_type_ids[i, :seq_len] = torch.tensor(token_type_ids_list[i], dtype=torch.long)
-                attention_mask[i, :seq_len] = torch.tensor(attention_mask_list[i], dtype=torch.long)
+            input_ids[i, :seq_len] = input_ids_list[i][:seq_len]
+            token_type_ids[i, :seq_len] = token_type_ids_list[i][:seq_len]
+            attention_mask[i, :seq_len] = 1
 
-            else:
-                input_ids[i] = torch.tensor(input_ids_list[i][:max_seq_len - 1] + [self.tokenizer.sep_token_id],
-                                            dtype=torch.long)
-                token_type_ids[i] = torch.tensor(token_type_ids_list[i][:max_seq_len], dtype=torch.long)
-                attention_mask[i] = torch.tensor(attention_mask_list[i][:max_seq_len], dtype=torch.long)
-        return input_ids, token_type_ids, attention_mask
+            if seq_lens[i] > max_seq_len:
+                input_ids[i, max_seq_len - 1] = self.tokenizer.sep_token_id
+
+        return torch.from_numpy(input_ids), torch.from_numpy(token_type_ids), torch.from_numpy(attention_mask)
+
+    def __call__(self, batch) -> dict:
+        if isinstance(batch, tuple):
+            # one (input_ids_list, token_type_ids_list, lengths) tuple from DGDataset.__getitems__
+            input_ids_list, token_type_ids_list, seq_lens = batch
+        else:
+            # a list of per-sample __getitem__ results, when the loader does not use __getitems__
+            input_ids_list, token_type_ids_list, seq_lens = list(zip(*batch))
+            seq_lens = np.asarray(seq_lens)
+        max_seq_len = min(int(seq_lens.max()), self.max_seq_len)
+
+        input_ids, token_type_ids, attention_mask = self.pad_and_truncate(input_ids_list,
+                                                                          token_type_ids_list,
+                                                                          seq_lens,
+                                                                          max_seq_len)
+        data_dict = {
+            'input_ids': input_ids,
+            'attention_mask': attention_mask,
+            'token_type_ids': token_type_ids
+        }
+
+        return data_dict
+
+
+class DGRawTextCollator:
+    def __init__(self, max_seq_len: int, tokenizer: BertTokenizerFast):
+        self.max_seq_len = max_seq_len
+        self.tokenizer = tokenizer
+
+    def __call__(self, examples: list) -> dict:
+        names, contents = list(zip(*examples))
+        inputs_dict = self.tokenizer(list(names), list(contents), add_special_tokens=True, padding='longest',
+                                     truncation=True, max_length=self.max_seq_len, return_token_type_ids=True,
+                                     return_attention_mask=True, return_tensors='pt')
+        data_dict = {
+            'input_ids': inputs_dict['input_ids'],
+            'attention_mask': inputs_dict['attention_mask'],
+            'token_type_ids': inputs_dict['token_type_ids']
+        }
+
+        return data_dict
+
+
+class DGTokenMasker:
+    """
+    Applies MLM masking to a batch that is already on the training device, so the random draws run as device
+    kernels instead of in the dataloader workers.
+    """
+
+    def __init__(self, tokenizer: BertTokenizerFast, device, mlm_probability=0.15):
+        self.mlm_probability = mlm_probability
+        self.mask_token_id = tokenizer.mask_token_id
+        self.vocab_size = len(tokenizer)
+        # same set get_special_tokens_mask checks: CLS, SEP, PAD, UNK and MASK
+        self.special_token_ids = torch.tensor(tokenizer.all_special_ids, dtype=torch.long, device=device)
 
     def mask_tokens(
             self, inputs: torch.Tensor, special_tokens_mask: Optional[torch.Tensor] = None
@@ -147,61 +283,54 @@ class DGDataCollator:
         """
         Prepare masked tokens inputs/labels for masked language modeling: 80% MASK, 10% random, 10% original.
         """
-        labels = inputs.clone()
-        # We sample a few tokens in each sequence for MLM training (with probability `self.mlm_probability`)
-        probability_matrix = torch.full(labels.shape, self.mlm_probability)
         if special_tokens_mask is None:
-            special_tokens_mask = [
-                self.tokenizer.get_special_tokens_mask(val, already_has_special_tokens=True) for val in labels.tolist()
-            ]
-            special_tokens_mask = torch.tensor(special_tokens_mask, dtype=torch.bool)
+            special_tokens_mask = torch.isin(inputs, self.special_token_ids)
         else:
             special_tokens_mask = special_tokens_mask.bool()
 
-        probability_matrix.masked_fill_(special_tokens_mask, value=0.0)
-        masked_indices = torch.bernoulli(probability_matrix).bool()
-        labels[~masked_indices] = -100  # We only compute loss on masked tokens
+        # One uniform draw per token both selects the tokens to mask (with probability `self.mlm_probability`)
+        # and, rescaled by that probability, decides their replacement: 80% MASK, 10% random word, 10% original.
+        # Every step is elementwise, so there is no host sync and no per-position indexing.
+        uniform = torch.rand(inputs.shape, device=inputs.device)
+        masked_indices = (uniform < self.mlm_probability) & ~special_tokens_mask
+        labels = inputs.masked_fill(~masked_indices, -100)  # We only compute loss on masked tokens
 
-        # 80% of the time, we replace masked input tokens with tokenizer.mask_token ([MASK])
-        indices_replaced = torch.bernoulli(torch.full(labels.shape, 0.8)).bool() & masked_indices
-        inputs[indices_replaced] = self.tokenizer.convert_tokens_to_ids(self.tokenizer.mask_token)
+        replace_prob = uniform / self.mlm_probability
+        indices_replaced = masked_indices & (replace_prob < 0.8)
+        indices_random = masked_indices & (replace_prob >= 0.8) & (replace_prob < 0.9)
 
-        # 10% of the time, we replace masked input tokens with random word
-        indices_random = torch.bernoulli(torch.full(labels.shape, 0.5)).bool() & masked_indices & ~indices_replaced
-        random_words = torch.randint(len(self.tokenizer), labels.shape, dtype=torch.long)
-        inputs[indices_random] = random_words[indices_random]
+        random_words = torch.randint_like(inputs, self.vocab_size)
+        inputs = torch.where(indices_random, random_words, inputs).masked_fill_(indices_replaced, self.mask_token_id)
 
-        # The rest of the time (10% of the time) we keep the masked input tokens unchanged
         return inputs, labels
 
-    def __call__(self, examples: list) -> dict:
-        input_ids_list, token_type_ids_list, attention_mask_list = list(zip(*examples))
-        cur_max_seq_len = max(len(input_id) for input_id in input_ids_list)
-        max_seq_len = min(cur_max_seq_len, self.max_seq_len)
-
-        input_ids, token_type_ids, attention_mask = self.pad_and_truncate(input_ids_list,
-                                                                          token_type_ids_list,
-                                                                          attention_mask_list,
-                                                                          max_seq_len)
-        input_ids, mlm_labels = self.mask_tokens(input_ids)
-        data_dict = {
-            'input_ids': input_ids,
-            'attention_mask': attention_mask,
-            'token_type_ids': token_type_ids,
-            'labels': mlm_labels
-        }
-
-        return data_dict
-
 
 def load_data(args, tokenizer):
-    with open(args.data_cache_path, 'rb') as f:
-        train_data = pickle.load(f)
-
-    collate_fn = DGDataCollator(args.max_seq_len, tokenizer)
-    train_dataset = DGDataset(train_data)
-    train_dataloader = DataLoader(dataset=train_dataset, batch_size=args.batch_size, shuffle=True,
-                                  num_workers=args.num_workers, collate_fn=collate_fn)
+    if args.lazy_tokenize:
+        collate_fn = DGRawTextCollator(args.max_seq_len, tokenizer)
+        train_dataset = RawTextDataset(*read_corpus(args))
+    else:
+        try:
+            train_data = load_npz(args.data_cache_path)
+        except ValueError:
+            # e.g. a pickle cache from before the npz format, which np.load refuses without allow_pickle
+            train_data = {}
+        if not all(key in train_data for key in ('input_ids', 'token_type_ids', 'offsets')):
+            print(f'\n>> {args.data_cache_path} has an outdated format, rebuilding ... ...')
+            train_data = read_data(args, tokenizer)
+        # caches written before lengths were stored can derive them from the offsets
+        lengths = train_data['lengths'] if 'lengths' in train_data else np.diff(train_data['offsets']).astype(np.int32)
+
+        collate_fn = DGDataCollator(args.max_seq_len, tokenizer)
+        train_dataset = DGDataset(train_data['input_ids'], train_data['token_type_ids'], train_data['offsets'],
+                                  lengths)
+
+    # worker-only options are rejected by DataLoader when loading in the main process
+    worker_kwargs = dict(persistent_workers=True, prefetch_factor=4) if args.num_workers > 0 else {}
+    bucket_sampler = LengthBucketSampler(train_dataset.lengths, args.batch_size)
+    train_dataloader = DataLoader(dataset=train_dataset, batch_sampler=bucket_sampler,
+                                  num_workers=args.num_workers, collate_fn=collate_fn,
+                                  pin_memory=args.device.startswith('cuda'), **worker_kwargs)
     return train_dataloader
 
 
@@ -218,11 +347,17 @@ class WarmupLinearSchedule(LambdaLR):
 
 
 def build_model_and_tokenizer(args):
-    tokenizer = BertTokenizer.from_pretrained(args.vocab_path)
+    tokenizer = BertTokenizerFast.from_pretrained(args.vocab_path)
     model_config = NeZhaConfig.from_pretrained(args.pretrain_model_path)
     model = NeZhaForMaskedLM.from_pretrained(pretrained_model_name_or_path=args.pretrain_model_path,
                                              config=model_config)
+    if args.gradient_checkpointing:
+        # recompute each layer's activations in backward so much larger batches fit in memory
+        model.gradient_checkpointing_enable()
     model.to(args.device)
+    if args.compile:
+        # batches are padded to their own longest sequence, so compile for dynamic sequence lengths
+        model = torch.compile(model, mode='max-autotune', dynamic=True)
 
     return tokenizer, model
 
@@ -233,51 +368,81 @@ def build_optimizer(args, model, train_steps):
     param_optimizer = list(model.named_parameters())
     optimizer_grouped_parameters = [
         {'params': [p for n, p in param_optimizer if not any(nd in n for nd in no_decay)],
-         'weight_decay_rate': args.weight_decay},
+         'weight_decay': args.weight_decay},
         {'params': [p for n, p in param_optimizer if any(nd in n for nd in no_decay)],
-         'weight_decay_rate': 0.0}
+         'weight_decay': 0.0}
     ]
 
-    optimizer = AdamW(optimizer_grouped_parameters, lr=args.learning_rate, eps=args.eps)
+    # the fused kernel is only available for CUDA parameters
+    optimizer = torch.optim.AdamW(optimizer_grouped_parameters, lr=args.learning_rate, eps=args.eps,
+                                  weight_decay=args.weight_decay, fused=args.device.startswith('cuda'))
     scheduler = WarmupLinearSchedule(optimizer, warmup_steps=train_steps * args.warmup_ratio, t_total=train_steps)
 
     return optimizer, scheduler
 
 
 def batch2cuda(args, batch):
-    return {item: value.to(args.device) for item, value in list(batch.items())}
+    return {item: value.to(args.device, non_blocking=True).long() for item, value in list(batch.items())}
 
 
 def create_dirs(path):
     os.makedirs(path, exist_ok=True)
 
 
-def save_model(args, model, tokenizer, global_steps, is_last=False):
+def write_checkpoint(model_to_save, state_dict, tokenizer, model_save_path):
+    model_to_save.save_pretrained(model_save_path, state_dict=state_dict,
+                                  save_function=partial(torch.save, _use_new_zipfile_serialization=True))
+    tokenizer.save_vocabulary(model_save_path)
+
+    print(f'\n>> model saved in : {model_save_path} .')
+
+
+def save_model(args, model, tokenizer, global_steps, is_last=False) -> threading.Thread:
     if isinstance(model, torch.nn.DataParallel):
         model = model.module
     model_to_save = model.module if hasattr(model, 'module') else model
+    # torch.compile wraps the model; save the original module so the weight names stay unprefixed
+    model_to_save = getattr(model_to_save, '_orig_mod', model_to_save)
     if is_last:
         model_save_path = os.path.join(args.save_path, f'checkpoint-{global_steps}')
     else:
         model_save_path = os.path.join(args.record_save_path, f'checkpoint-{global_steps}')
-    model_to_save.save_pretrained(model_save_path)
-    tokenizer.save_vocabulary(model_save_path)
+    # created up front so checkpoint rotation already sees it while the weights are still being written
+    os.makedirs(model_save_path, exist_ok=True)
 
-    print(f'\n>> model saved in : {model_save_path} .')
+    # snapshot the weights on the cpu, then let training continue while a thread serializes the snapshot
+    # tied weights (the MLM decoder shares the word embeddings) are copied once, so torch.save writes them once
+    cpu_state_dict, cpu_copies = {}, {}
+    for k, v in model_to_save.state_dict().items():
+        storage_key = (v.data_ptr(), v.shape, v.stride())
+        if storage_key not in cpu_copies:
+            cpu_copies[storage_key] = v.detach().to('cpu', copy=True)
+        cpu_state_dict[k] = cpu_copies[storage_key]
+
+    save_thread = threading.Thread(target=write_checkpoint, daemon=True,
+                                   args=(model_to_save, cpu_state_dict, tokenizer, model_save_path))
+    save_thread.start()
+
+    return save_thread
 
 
 def sorted_checkpoints(args, best_model_checkpoint, checkpoint_prefix=PREFIX_CHECKPOINT_DIR, use_mtime=False):
     ordering_and_checkpoint_path = []
 
-    glob_checkpoints = [str(x) for x in Path(args.record_save_path).glob(f"{checkpoint_prefix}-*")]
+    checkpoint_re = (_CKPT_RE if checkpoint_prefix == PREFIX_CHECKPOINT_DIR
+                     else re.compile(f".*{checkpoint_prefix}-([0-9]+)$"))
 
-    for path in glob_checkpoints:
-        if use_mtime:
-            ordering_and_checkpoint_path.append((os.path.getmtime(path), path))
-        else:
-            regex_match = re.match(f".*{checkpoint_prefix}-([0-9]+)", path)
-            if regex_match and regex_match.groups():
-                ordering_and_checkpoint_path.append((int(regex_match.groups()[0]), path))
+    # scandir returns the entries with their stat info cached, so mtime ordering needs no extra syscall per entry
+    with os.scandir(str(Path(args.record_save_path))) as entries:
+        for entry in entries:
+            if not entry.name.startswith(f"{checkpoint_prefix}-"):
+                continue
+            if use_mtime:
+                ordering_and_checkpoint_path.append((entry.stat(follow_symlinks=False).st_mtime, entry.path))
+            else:
+                regex_match = checkpoint_re.match(entry.name)
+                if regex_match and regex_match.groups():
+                    ordering_and_checkpoint_path.append((int(regex_match.groups()[0]), entry.path))
 
     checkpoints_sorted = sorted(ordering_and_checkpoint_path)
     checkpoints_sorted = [checkpoint[1] for checkpoint in checkpoints_sorted]
@@ -291,7 +456,8 @@ def sorted_checkpoints(args, best_model_checkpoint, checkpoint_prefix=PREFIX_CHE
     return checkpoints_sorted
 
 
-def rotate_checkpoints(args, best_model_checkpoint, use_mtime=False) -> None:
+def rotate_checkpoints(args, best_model_checkpoint, use_mtime=False,
+                       rm_pool: Optional[ThreadPoolExecutor] = None) -> None:
     if args.save_total_limit is None or args.save_total_limit <= 0:
         return
 
@@ -303,7 +469,10 @@ def rotate_checkpoints(args, best_model_checkpoint, use_mtime=False) -> None:
     number_of_checkpoints_to_delete = max(0, len(checkpoints_sorted) - args.save_total_limit)
     checkpoints_to_be_deleted = checkpoints_sorted[:number_of_checkpoints_to_delete]
     for checkpoint in checkpoints_to_be_deleted:
-        shutil.rmtree(checkpoint)
+        if rm_pool is not None:
+            rm_pool.submit(shutil.rmtree, checkpoint, ignore_errors=True)
+        else:
+            shutil.rmtree(checkpoint)
 
 
 def pretrain(args):
@@ -312,21 +481,29 @@ def pretrain(args):
 
     tokenizer, model = build_model_and_tokenizer(args)
 
-    if not os.path.exists(os.path.join(args.data_cache_path)):
+    if not args.lazy_tokenize and not os.path.exists(os.path.join(args.data_cache_path)):
         read_data(args, tokenizer)
 
     train_dataloader = load_data(args, tokenizer)
+    token_masker = DGTokenMasker(tokenizer, args.device)
 
     total_steps = args.num_epochs * len(train_dataloader)
 
     optimizer, scheduler = build_optimizer(args, model, total_steps)
 
-    total_loss, cur_avg_loss, global_steps = 0., 0., 0
+    # losses are accumulated on the device and only synchronized with .item() when logging
+    total_loss = torch.zeros((), device=args.device)
+    cur_avg_loss = torch.zeros((), device=args.device)
+    global_steps = 0
 
-    if args.fp16:
-        scaler = GradScaler()
+    # bfloat16 has the fp32 exponent range and needs no loss scaling; fp16 (pre-Ampere GPUs) keeps the GradScaler
+    amp_dtype = torch.bfloat16 if args.bf16 else torch.float16
+    scaler = GradScaler(enabled=args.fp16 and not args.bf16)
 
     pretrain_loss_list, global_steps_list = [], []
+    save_thread = None
+    # old checkpoints are deleted in the background so rotation does not block training
+    rm_pool = ThreadPoolExecutor(max_workers=1)
 
     for epoch in range(1, args.num_epochs + 1):
 
@@ -336,59 +513,56 @@ def pretrain(args):
 
         for step, batch in enumerate(train_iterator):
             batch_cuda = batch2cuda(args, batch)
+            batch_cuda['input_ids'], batch_cuda['labels'] = token_masker.mask_tokens(batch_cuda['input_ids'])
 
-            if args.fp16:
-                with autocast():
-                    loss, logits = model(**batch_cuda)[:2]
-                scaler.scale(loss).backward()
-            else:
+            with torch.autocast(device_type=args.device.split(':')[0], dtype=amp_dtype,
+                                enabled=args.bf16 or args.fp16):
                 loss, logits = model(**batch_cuda)[:2]
-                loss.backward()
+            scaler.scale(loss).backward()
 
             if args.gradient_accumulation_steps > 1:
                 loss = loss / args.gradient_accumulation_steps
 
-            pretrain_loss_list.append(loss.item())
-            global_steps_list.append(global_steps + 1)
-
-            total_loss += loss.item()
-            cur_avg_loss += loss.item()
+            total_loss += loss.detach()
+            cur_avg_loss += loss.detach()
 
             if (step + 1) % args.gradient_accumulation_steps == 0:
-                if args.fp16:
-                    scaler.unscale_(optimizer)
-
+                scaler.unscale_(optimizer)
                 torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
-
-                if args.fp16:
-                    scaler.step(optimizer)
-                    scaler.update()
-                else:
-                    optimizer.step()
+                scaler.step(optimizer)
+                scaler.update()
 
                 scheduler.step()
-                optimizer.zero_grad()
+                optimizer.zero_grad(set_to_none=True)
 
                 if (global_steps + 1) % args.logging_step == 0:
-                    epoch_avg_loss = cur_avg_loss / args.logging_step
-                    global_avg_loss = total_loss / (global_steps + 1)
+                    epoch_avg_loss = cur_avg_loss.item() / args.logging_step
+                    global_avg_loss = total_loss.item() / (global_steps + 1)
+
+                    pretrain_loss_list.append(epoch_avg_loss)
+                    global_steps_list.append(global_steps + 1)
 
                     print(f"\n>> epoch - {epoch},  global steps - {global_steps + 1}, "
                           f"epoch avg loss - {epoch_avg_loss:.4f}, global avg loss - {global_avg_loss:.4f}.")
 
-                    cur_avg_loss = 0.0
+                    cur_avg_loss.zero_()
                 global_steps += 1
 
                 lr = scheduler.get_last_lr()[0]
-                train_iterator.set_postfix_str(f'loss : {loss.item():.4f}, lr : {lr}, global steps : {global_steps} .')
+                train_iterator.set_postfix_str(f'lr : {lr}, global steps : {global_steps} .')
 
             if (global_steps + 1) % args.save_steps == 0:
-                save_model(args, model, tokenizer, global_steps)
+                if save_thread is not None:
+                    save_thread.join()
+                save_thread = save_model(args, model, tokenizer, global_steps)
                 last_checkpoint_save_path = os.path.join(args.record_save_path, f'checkpoint-{global_steps}')
-                rotate_checkpoints(args, last_checkpoint_save_path, use_mtime=False)
+                rotate_checkpoints(args, last_checkpoint_save_path, use_mtime=False, rm_pool=rm_pool)
 
     print('\n>> saving model at last epoch ... ...')
-    save_model(args, model, tokenizer, global_steps, True)
+    if save_thread is not None:
+        save_thread.join()
+    save_model(args, model, tokenizer, global_steps, True).join()
+    rm_pool.shutdown(wait=True)
 
     fig, ax = plt.subplots()
     ax.plot(global_steps_list, pretrain_loss_list, 'k', label='pretrain_loss')
@@ -415,15 +589,16 @@ def main_pretrain():
     new_pretrain_dir = 'data/new_pretrain_dir/0113'
     parser = ArgumentParser()
 
-    parser.add_argument('--num_workers', type=int, default=0)
+    parser.add_argument('--num_workers', type=int, default=4)
 
     parser.add_argument('--debug', type=bool, default=False)
+    parser.add_argument('--lazy_tokenize', action=BooleanOptionalAction, default=False)
     parser.add_argument('--pretrain_data_dir', type=str,
                         default=pretrain_data_dir)
     parser.add_argument('--pretrain_model_path', type=str,
                         default=pre_model_dir)
     parser.add_argument('--data_cache_path', type=str,
-                        default=f'{pretrain_data_dir}/pretrain.pkl')
+                        default=f'{pretrain_data_dir}/pretrain.npz')
     parser.add_argument('--vocab_path', type=str,
                         default=f'{pre_model_dir}/vocab.txt')
     parser.add_argument('--save_path', type=str,
@@ -449,7 +624,15 @@ def main_pretrain():
     parser.add_argument('--logging_step', type=int, default=2000)
     parser.add_argument('--seed', type=int, default=9527)
 
-    parser.add_argument('--fp16', type=str, default=True)
+    # bf16 on GPUs that support it (Ampere and newer), otherwise fp16 with loss scaling; --bf16 wins if both are set
+    bf16_supported = torch.cuda.is_available() and torch.cuda.is_bf16_supported()
+    parser.add_argument('--bf16', action=BooleanOptionalAction, default=bf16_supported)
+    parser.add_argument('--fp16', action=BooleanOptionalAction,
+                        default=torch.cuda.is_available() and not bf16_supported)
+    parser.add_argument('--compile', action=BooleanOptionalAction, default=True)
+    # opt-in: trades recompute for activation memory, only pays off together with a larger --batch_size
+    # (scale --learning_rate and the step-based options with it, the defaults are tuned for batch size 32)
+    parser.add_argument('--gradient_checkpointing', action=BooleanOptionalAction, default=False)
 
     parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
 